@@ -1,26 +1,54 @@
+import asyncio
+import json
+import logging
+import math
 import os
+import re
 import sys
+import tempfile
+import time
 import ollama
 import structlog
-from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
-
-structlog.configure(
-    processors=[
-        structlog.contextvars.merge_contextvars,
-        structlog.stdlib.add_log_level,
-        structlog.stdlib.PositionalArgumentsFormatter(),
-        structlog.processors.TimeStamper(fmt="%Y-%m-%d %H:%M:%S"),
-        structlog.processors.StackInfoRenderer(),
-        structlog.processors.format_exc_info,
-        structlog.dev.ConsoleRenderer(colors=True),
-    ],
-    wrapper_class=structlog.stdlib.BoundLogger,
-    logger_factory=structlog.stdlib.LoggerFactory(),
-    cache_logger_on_first_use=True,
-)
+from tenacity import retry, stop_after_attempt, wait_exponential_jitter, retry_if_exception
+
 log = structlog.get_logger()
+# Lazy proxy: the binding is resolved on first use, after main() has configured structlog.
+_AGENT_LOG = structlog.get_logger(agent="QAAgent")
+
+_DURATION_RE = re.compile(r"-?(\d+(\.\d*)?(ns|us|µs|ms|s|m|h))+")
+
+
+def _parse_keep_alive(value: str) -> float | str:
+    """Return `value` as seconds or a Go duration string; unset or invalid means -1."""
+    value = value.strip()
+    try:
+        seconds = float(value)
+    except ValueError:
+        return value if _DURATION_RE.fullmatch(value) else -1
+    # nan/inf would be serialised as the non-JSON tokens NaN/Infinity.
+    return seconds if math.isfinite(seconds) else -1
 
+
+def _parse_num_parallel(value: str) -> int:
+    """Return `value` as a request count; unset or invalid means 0."""
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        return 0
+
+
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://127.0.0.1:11434")
 MODEL = os.getenv("OLLAMA_MODEL", "phi3:mini")
+# Ollama accepts either a duration string ("10m", "1h") or a number of seconds;
+# a negative number keeps the model loaded indefinitely.
+KEEP_ALIVE = _parse_keep_alive(os.getenv("OLLAMA_KEEP_ALIVE", "-1"))
+# Mirrors the server's OLLAMA_NUM_PARALLEL; the API does not report it, so the
+# agent relies on being given the same value (0 means "not configured").
+NUM_PARALLEL = _parse_num_parallel(os.getenv("OLLAMA_NUM_PARALLEL", ""))
+MODEL_CACHE_PATH = os.path.join(
+    os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "buildit-agent", "models.json"
+)
+MODEL_CACHE_TTL = 300  # seconds
 USER_STORY = "As a user, I want to log in with my email and password so I can access my account."
 SYSTEM_PROMPT = """
 You are an elite QA Engineer. Your task is to generate a **complete, thorough BDD feature file** in **Gherkin syntax** based on a user story.
@@ -86,25 +114,92 @@ Feature: User Authentication
 ```
 """
 
+def _load_model_cache() -> dict:
+    try:
+        with open(MODEL_CACHE_PATH, encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    # Anything other than the expected {host: {model: entry}} shape is treated as empty.
+    return cache if isinstance(cache, dict) else {}
+
+
+def _is_model_cached(host: str, model: str) -> bool:
+    """Return True if `model` was confirmed on `host` within the cache TTL."""
+    models = _load_model_cache().get(host)
+    entry = models.get(model) if isinstance(models, dict) else None
+    checked_at = entry.get("checked_at") if isinstance(entry, dict) else None
+    return isinstance(checked_at, (int, float)) and time.time() - checked_at <= MODEL_CACHE_TTL
+
+
+def _write_model_cache(host: str, model: str) -> None:
+    """Record `model` as present on `host`, replacing the cache file atomically."""
+    cache = _load_model_cache()
+    if not isinstance(cache.get(host), dict):
+        cache[host] = {}
+    cache[host][model] = {"checked_at": time.time()}
+    _save_model_cache(cache)
+
+
+def _evict_model_cache(host: str, model: str) -> None:
+    """Forget `model` on `host` so the next check asks the server again."""
+    cache = _load_model_cache()
+    if isinstance(cache.get(host), dict) and cache[host].pop(model, None) is not None:
+        _save_model_cache(cache)
+
+
+def _save_model_cache(cache: dict) -> None:
+    try:
+        cache_dir = os.path.dirname(MODEL_CACHE_PATH)
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=cache_dir, delete=False, encoding="utf-8") as f:
+            json.dump(cache, f)
+        os.replace(f.name, MODEL_CACHE_PATH)
+    except OSError:
+        # The cache is only an optimisation; a read-only home directory must not fail the run.
+        log.warning("Could not write model cache.", path=MODEL_CACHE_PATH)
+
+def _is_retryable(exc: BaseException) -> bool:
+    """Retry server-side and rate-limit errors; other 4xx responses will fail again."""
+    if not isinstance(exc, ollama.ResponseError):
+        return False
+    return exc.status_code == 429 or not 400 <= exc.status_code < 500
+
 class QAAgent:
-    def __init__(self, model: str, user_story: str):
+    def __init__(self, model: str, user_stories: list[str], system_prompt: str = SYSTEM_PROMPT):
         self.model = model
-        self.user_story = user_story
-        self.log = structlog.get_logger(agent=self.__class__.__name__)
+        self.user_stories = user_stories
+        self.system_prompt = system_prompt
+        # One client per agent so list/pull/generate reuse the same connection pool.
+        self.client = ollama.AsyncClient(host=OLLAMA_HOST)
+        self.log = _AGENT_LOG
 
-    def run(self):
+    async def run(self):
         try:
             self.log.info("=" * 20 + " AI QA Agent Initializing " + "=" * 20)
-            self.log.info("Objective Received", story=self.user_story)
+            for story in self.user_stories:
+                self.log.info("Objective Received", story=story)
             self.log.info("Model Specified", model=self.model)
 
-            self._ensure_model_available()
+            self._check_concurrency()
+            model_cached, _ = await asyncio.gather(self._ensure_model_available(), self._preload())
 
             self.log.info("=" * 20 + " Generating Test Plan " + "=" * 20)
-            generated_plan = self._generate_test_plan()
+            try:
+                generated_plans = await self._generate_test_plans()
+            except ollama.ResponseError as e:
+                # A cache hit skips list()/pull(), so a model removed from the server
+                # since then only shows up here; re-check and pull it once.
+                if not (model_cached and e.status_code == 404):
+                    raise
+                self.log.warning("Cached model is missing on the server. Re-checking...", model=self.model)
+                _evict_model_cache(OLLAMA_HOST, self.model)
+                await self._ensure_model_available()
+                generated_plans = await self._generate_test_plans()
 
             self.log.info("=" * 20 + " Mission Complete " + "=" * 20)
-            print(generated_plan)
+            sys.stdout.buffer.write("\n\n".join(generated_plans).encode("utf-8") + b"\n")
+            sys.stdout.buffer.flush()
 
         except ollama.ResponseError as e:
             self.log.error(
@@ -117,30 +212,91 @@ class QAAgent:
             self.log.exception("An unexpected error occurred.")
             sys.exit(1)
 
-    def _ensure_model_available(self):
+    async def _ensure_model_available(self) -> bool:
+        """Make sure the model exists on the server; return True if only the cache was consulted."""
         try:
-            local_models = [m["name"] for m in ollama.list()["models"]]
-            if self.model in local_models:
+            if _is_model_cached(OLLAMA_HOST, self.model):
+                self.log.info("Model is available locally (cached).", model=self.model)
+                return True
+
+            if any(m["name"] == self.model for m in (await self.client.list())["models"]):
+                _write_model_cache(OLLAMA_HOST, self.model)
                 self.log.info("Model is available locally.", model=self.model)
-                return
+                return False
 
             self.log.warning("Model not found locally. Pulling from Ollama Hub...", model=self.model)
 
-            current_digest = ""
-            for status in ollama.pull(self.model, stream=True):
-                if status.get("digest"):
-                    current_digest = status["digest"]
+            await self.client.pull(self.model)
 
-            self.log.info("Successfully pulled model.", model=self.model, digest=current_digest)
+            _write_model_cache(OLLAMA_HOST, self.model)
+            self.log.info("Successfully pulled model.", model=self.model)
+            return False
 
         except Exception:
             self.log.exception("Failed to pull model.", model=self.model)
             raise
 
+    async def _preload(self):
+        # An empty prompt only loads the model into memory; running it alongside the
+        # availability check hides the load time behind the list/pull round trips.
+        # This is already the cheapest way to force residency: the server returns
+        # without prefill or sampling, whereas a one-token generate would run both,
+        # and an extra show() probe would only add a round trip on the happy path.
+        try:
+            await self.client.generate(model=self.model, prompt="", keep_alive=KEEP_ALIVE)
+            self.log.info("Model preloaded.", model=self.model)
+        except ollama.ResponseError as e:
+            # Expected while the model is still being pulled; the first real
+            # generate call will load it instead.
+            self.log.info("Model preload skipped.", model=self.model, error=e.error)
+
+    def _check_concurrency(self):
+        # Concurrency only matters when several stories are generated at once.
+        if len(self.user_stories) < 2:
+            return
+
+        if NUM_PARALLEL != 1:
+            self.log.info(
+                "Generating user stories concurrently.",
+                stories=len(self.user_stories),
+                num_parallel=NUM_PARALLEL or "server default",
+            )
+        else:
+            self.log.warning(
+                "Server decodes one request at a time; user stories will be processed serially.",
+                stories=len(self.user_stories),
+                num_parallel=NUM_PARALLEL,
+                remediation=(
+                    "Restart the Ollama server with OLLAMA_NUM_PARALLEL set to at least the "
+                    "number of stories and pass the same value to the agent."
+                ),
+            )
+
+    async def _generate_test_plans(self) -> list[str]:
+        # Requests are issued concurrently; the server only decodes them in
+        # parallel when started with OLLAMA_NUM_PARALLEL > 1.
+        return await asyncio.gather(
+            *(self._generate_test_plan(story) for story in self.user_stories)
+        )
+
+    async def _stream_generate(self, **kwargs):
+        stream = await self.client.generate(stream=True, **kwargs)
+        try:
+            async for chunk in stream:
+                yield chunk
+        except RuntimeError as e:
+            # ollama's AsyncClient reads the body of an HTTP error response with the
+            # sync API, which raises RuntimeError on an async stream. Recover the
+            # status from the underlying httpx error so callers see a ResponseError.
+            response = getattr(e.__context__, "response", None)
+            if response is None:
+                raise
+            raise ollama.ResponseError(response.reason_phrase, response.status_code) from None
+
     @retry(
         stop=stop_after_attempt(5),
-        wait=wait_fixed(3),
-        retry=retry_if_exception_type(ollama.ResponseError),
+        wait=wait_exponential_jitter(initial=0.2, max=5, jitter=0.2),
+        retry=retry_if_exception(_is_retryable),
         reraise=True,
         before_sleep=lambda retry_state: log.warning(
             "Retrying API call...",
@@ -148,27 +304,66 @@ class QAAgent:
             wait=retry_state.next_action.sleep,
         ),
     )
-    def _generate_test_plan(self) -> str:
+    async def _generate_test_plan(self, user_story: str) -> str:
         self.log.info("Agent is thinking... Crafting a professional-grade test plan...")
-        response = ollama.generate(
+        # Tokens are echoed to stderr as they arrive when a human is watching a
+        # single story; stdout only ever receives the extracted plans.
+        echo = len(self.user_stories) == 1 and sys.stderr.isatty()
+        chunks = []
+        async for chunk in self._stream_generate(
             model=self.model,
-            prompt=self.user_story,
-            system=SYSTEM_PROMPT,
-            stream=False,
-        )
+            prompt=user_story,
+            system=self.system_prompt,
+            keep_alive=KEEP_ALIVE,
+        ):
+            chunks.append(chunk["response"])
+            if echo:
+                sys.stderr.write(chunk["response"])
+                sys.stderr.flush()
+        if echo:
+            sys.stderr.write("\n")
         self.log.info("Agent has finished generating the plan.")
 
-        response_text = response.get("response", "")
-        if "```gherkin" in response_text:
-            return response_text.split("```gherkin")[1].split("```")[0].strip()
-        elif "```" in response_text:
-            return response_text.split("```")[1].strip()
+        response_text = "".join(chunks)
+        start = response_text.find("```gherkin")
+        if start >= 0:
+            start += len("```gherkin")
         else:
-            return response_text
+            start = response_text.find("```")
+            if start < 0:
+                return response_text
+            start += len("```")
+        end = response_text.find("```", start)
+        return response_text[start:end if end >= 0 else None].strip()
+
+def _configure_logging():
+    # structlog hands records to the stdlib logger named after this module. Without
+    # a handler only Python's last-resort WARNING output appeared, so give that
+    # logger its own INFO handler; third-party loggers (httpx) stay at WARNING.
+    logger = logging.getLogger(__name__)
+    logger.addHandler(logging.StreamHandler(sys.stderr))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+    structlog.configure(
+        processors=[
+            structlog.contextvars.merge_contextvars,
+            structlog.stdlib.add_log_level,
+            structlog.stdlib.PositionalArgumentsFormatter(),
+            structlog.processors.TimeStamper(fmt="%Y-%m-%d %H:%M:%S"),
+            structlog.processors.StackInfoRenderer(),
+            structlog.processors.format_exc_info,
+            structlog.dev.ConsoleRenderer(colors=sys.stderr.isatty()),
+        ],
+        wrapper_class=structlog.stdlib.BoundLogger,
+        logger_factory=structlog.stdlib.LoggerFactory(),
+        cache_logger_on_first_use=True,
+    )
 
 def main():
-    agent = QAAgent(model=MODEL, user_story=USER_STORY)
-    agent.run()
+    _configure_logging()
+    agent = QAAgent(model=MODEL, user_stories=sys.argv[1:] or [USER_STORY])
+    asyncio.run(agent.run())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file